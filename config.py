@@ -3,3 +3,42 @@
 # Chunking settings
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
+
+# Ingestion memory bounds
+# これを超えるサイズのファイルは処理せずスキップする
+MAX_FILE_SIZE_MB = 200
+# PDFはこのページ数ずつ一時ファイルに切り出して要素へ分割する
+PDF_PAGES_PER_PARTITION = 20
+# PDFを切り出す一時ファイルの置き場所（Noneの場合はシステムの一時ディレクトリ）
+SPILL_DIR = None
+# テキストファイルを読み込む際のブロックサイズ（文字数）
+TEXT_BLOCK_SIZE = 64 * 1024
+# テキストファイルのエンコーディング候補（先頭から順に試す）
+TEXT_ENCODINGS = ("utf-8-sig", "cp932", "euc_jp")
+# チャンキング前に溜めるテキストの上限（文字数）
+CHUNK_BUFFER_SIZE = CHUNK_SIZE * 16
+# 1回のadd_documentsで送信するチャンク数の上限
+INGEST_BATCH_SIZE = 64
+# 1バッチで保持するチャンク本文の上限（バイト）
+INGEST_BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+# Ingestion scheduling (優先度は小さいほど先に処理する)
+# 入力ディレクトリ配下のサブディレクトリ名ごとの優先度
+PRIORITY_DIRS = {"urgent": 0, "archive": 3}
+# サブディレクトリで決まらない場合の拡張子ごとの優先度（処理の軽いテキストをPDFより先に処理する）
+PRIORITY_SUFFIXES = {".txt": 1, ".md": 1, ".json": 1, ".pdf": 2}
+DEFAULT_PRIORITY = 1
+# これを超えるサイズのファイルは優先度を1段階下げる
+LARGE_FILE_MB = 50
+# これ以下のテキストファイルは、同じ優先度の中でサイズの小さい順に処理する
+SMALL_TEXT_FILE_KB = 256
+
+# Embedding rate control
+# 埋め込み処理のスループット上限（チャンク/秒）
+EMBED_MAX_CHUNKS_PER_SEC = 50
+# 検索レイテンシ悪化時に絞り込む下限（チャンク/秒）
+EMBED_MIN_CHUNKS_PER_SEC = 2
+# 検索レイテンシ（p95）の目標値。これを超えると埋め込み処理を絞り込む
+SEARCH_LATENCY_TARGET_MS = 500
+# 検索レイテンシを取得する間隔（秒）
+METRICS_POLL_INTERVAL_SEC = 10
@@ -1,4 +1,7 @@
 import os
+import time
+import threading
+from collections import deque
 from fastapi import FastAPI, Depends
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
@@ -10,6 +13,17 @@ load_dotenv()
 
 app = FastAPI()
 
+# 直近の検索レイテンシ（記録時刻, ミリ秒）。ingesterが埋め込み処理の抑制判断に使う
+SEARCH_LATENCY_WINDOW = 200
+SEARCH_LATENCY_WINDOW_SEC = 60
+search_latencies_ms = deque(maxlen=SEARCH_LATENCY_WINDOW)
+# 同期エンドポイントはスレッドプールで並行実行されるため、dequeの操作はロックで保護する
+search_latencies_lock = threading.Lock()
+
+def _expire_search_latencies(now):
+    while search_latencies_ms and now - search_latencies_ms[0][0] > SEARCH_LATENCY_WINDOW_SEC:
+        search_latencies_ms.popleft()
+
 # lru_cacheを使って、モデルとクライアントのインスタンスをキャッシュする
 @lru_cache(maxsize=None)
 def get_model():
@@ -34,6 +48,10 @@ class SearchResult(BaseModel):
 class RagSearchResponse(BaseModel):
     results: list[SearchResult]
 
+class SearchMetricsResponse(BaseModel):
+    search_latency_p95_ms: float
+    count: int
+
 @app.post("/rag/search", response_model=RagSearchResponse)
 def rag_search(
     request: RagSearchRequest,
@@ -41,6 +59,7 @@ def rag_search(
     meili_client: meilisearch.Client = Depends(get_meili_client)
 ):
     index_name = os.getenv("INDEX_NAME", "documents")
+    started = time.perf_counter()
 
     query_vector = model.encode(request.query).tolist()
 
@@ -59,4 +78,17 @@ def rag_search(
         for hit in search_results.get('hits', [])
     ]
 
+    latency_ms = (time.perf_counter() - started) * 1000
+    with search_latencies_lock:
+        search_latencies_ms.append((time.monotonic(), latency_ms))
     return RagSearchResponse(results=formatted_results)
+
+@app.get("/metrics", response_model=SearchMetricsResponse)
+def search_metrics():
+    # 古いサンプルを捨て、検索がない間に過去の遅いレイテンシを報告し続けないようにする
+    with search_latencies_lock:
+        _expire_search_latencies(time.monotonic())
+        snapshot = list(search_latencies_ms)
+    latencies = sorted(latency for _, latency in snapshot)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+    return SearchMetricsResponse(search_latency_p95_ms=p95, count=len(latencies))
@@ -1,25 +1,155 @@
 import os
 import json
+import codecs
+import hashlib
 import time
+import heapq
+import itertools
+import threading
+import urllib.request
 import logging
+import tempfile
 from pathlib import Path
+import numpy as np
 from dotenv import load_dotenv
 import meilisearch
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from unstructured.partition.pdf import partition_pdf
 from unstructured.partition.text import partition_text
+from pypdf import PdfReader, PdfWriter
 from sentence_transformers import SentenceTransformer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import config
 
 load_dotenv()
 
+SUPPORTED_SUFFIXES = ('.json', '.pdf', '.txt', '.md')
+SMALL_TEXT_SUFFIXES = ('.json', '.txt', '.md')
+MB = 1024 * 1024
+
 def setup_logging(log_file_path):
     """ロギングを設定する"""
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
                         handlers=[logging.FileHandler(log_file_path), logging.StreamHandler()])
 
+class IngestScheduler:
+    """ファイルを優先度付きキューに積み、ワーカースレッドで優先度の高い順に処理する"""
+
+    def __init__(self, process, input_dir):
+        self.process = process
+        self.input_dir = Path(input_dir)
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def classify(self, file_path):
+        """(優先度, SJF対象外フラグ, サイズ)を返す。SJF対象外のファイルは投入順に処理する"""
+        try:
+            size = file_path.stat().st_size
+        except OSError:
+            size = 0
+
+        priority = config.PRIORITY_SUFFIXES.get(file_path.suffix, config.DEFAULT_PRIORITY)
+        try:
+            parts = file_path.relative_to(self.input_dir).parts[:-1]
+        except ValueError:
+            parts = ()
+        dir_priorities = [config.PRIORITY_DIRS[p] for p in parts if p in config.PRIORITY_DIRS]
+        if dir_priorities:
+            priority = min(dir_priorities)
+        if size > config.LARGE_FILE_MB * MB:
+            priority += 1
+
+        if file_path.suffix in SMALL_TEXT_SUFFIXES and size <= config.SMALL_TEXT_FILE_KB * 1024:
+            return (priority, 0, size)
+        return (priority, 1, 0)
+
+    def submit(self, file_path_str):
+        file_path = Path(file_path_str)
+        with self._cond:
+            key = self.classify(file_path) + (next(self._seq),)
+            heapq.heappush(self._queue, (key, str(file_path)))
+            self._cond.notify()
+
+    def next(self, timeout=None):
+        """次に処理するファイルを返す。timeout内にファイルがなければNoneを返す"""
+        with self._cond:
+            if not self._queue and not self._stopped:
+                self._cond.wait(timeout)
+            while self._queue and not self._stopped:
+                key, file_path_str = heapq.heappop(self._queue)
+                # 投入時点（on_created直後）では書き込み途中のことが多いため、取り出す時点で分類し直す
+                current = self.classify(Path(file_path_str))
+                if current != key[:3]:
+                    heapq.heappush(self._queue, (current + key[3:], file_path_str))
+                    continue
+                return file_path_str
+            return None
+
+    def run(self):
+        while not self._stopped:
+            file_path_str = self.next(timeout=1)
+            if file_path_str:
+                self.process(file_path_str)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+class EmbeddingThrottle:
+    """埋め込み処理のスループットを制限し、検索レイテンシが悪化したら上限を絞り込む"""
+
+    def __init__(self, max_rate, min_rate, latency_target_ms):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.latency_target_ms = latency_target_ms
+        self.rate = max_rate
+        self._next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n):
+        """n件のチャンクを埋め込む前に呼び、スループット上限を超えないよう待機する"""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_at)
+            self._next_at = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def update(self, latency_ms):
+        """検索レイテンシが目標を超えたら上限を半減し、目標内なら少しずつ戻す"""
+        with self._lock:
+            previous = self.rate
+            if latency_ms > self.latency_target_ms:
+                self.rate = max(self.min_rate, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+        if self.rate != previous:
+            logging.info(f"Embedding rate changed to {self.rate:.1f} chunks/sec "
+                         f"(search latency p95: {latency_ms:.0f}ms)")
+
+def poll_search_latency(throttle, metrics_url, interval):
+    """fastmcpの/metricsから検索レイテンシを定期的に取得し、埋め込み処理の上限に反映する"""
+    failing = False
+    while True:
+        try:
+            with urllib.request.urlopen(metrics_url, timeout=5) as response:
+                metrics = json.load(response)
+            # 直近の検索がない場合はp95が0となり、上限は徐々に戻る
+            throttle.update(metrics['search_latency_p95_ms'])
+            if failing:
+                logging.info(f"Fetching search metrics from {metrics_url} recovered")
+                failing = False
+        except Exception as e:
+            # 取得できない間は毎回警告せず、最初の1回だけ警告する
+            log = logging.debug if failing else logging.warning
+            log(f"Failed to fetch search metrics from {metrics_url}: {e}")
+            failing = True
+        time.sleep(interval)
+
 class IngesterHandler(FileSystemEventHandler):
     def __init__(self, client, index_name, input_dir):
         self.client = client
@@ -33,6 +163,12 @@ class IngesterHandler(FileSystemEventHandler):
             chunk_size=config.CHUNK_SIZE,
             chunk_overlap=config.CHUNK_OVERLAP
         )
+        self.scheduler = IngestScheduler(self.process_file, self.input_dir)
+        self.throttle = EmbeddingThrottle(
+            max_rate=config.EMBED_MAX_CHUNKS_PER_SEC,
+            min_rate=config.EMBED_MIN_CHUNKS_PER_SEC,
+            latency_target_ms=config.SEARCH_LATENCY_TARGET_MS
+        )
 
         self._load_processed_files()
 
@@ -48,36 +184,52 @@ class IngesterHandler(FileSystemEventHandler):
             f.write(filename + '\n')
         self.processed_files.add(filename)
 
+    def _source_name(self, file_path):
+        """入力ディレクトリからの相対パスを返す。サブディレクトリ間で同名のファイルを区別するために使う"""
+        try:
+            return file_path.relative_to(self.input_dir).as_posix()
+        except ValueError:
+            return file_path.name
+
     def process_file(self, file_path_str):
         file_path = Path(file_path_str)
-        if file_path.name in self.processed_files or file_path.name.startswith('.'):
+        source_name = self._source_name(file_path)
+        if source_name in self.processed_files or file_path.name.startswith('.'):
+            return
+        if file_path.suffix not in SUPPORTED_SUFFIXES:
+            logging.warning(f"Skipping unsupported file type: {source_name}")
             return
 
-        logging.info(f"Processing file: {file_path.name}")
-        documents = []
         try:
-            text_to_process = ""
-            if file_path.suffix == '.json':
-                text_to_process = self._extract_text_from_json(file_path)
-            elif file_path.suffix == '.pdf':
-                text_to_process = self._extract_text_from_pdf(file_path)
-            elif file_path.suffix in ['.txt', '.md']:
-                text_to_process = self._extract_text_from_file(file_path)
-            else:
-                logging.warning(f"Skipping unsupported file type: {file_path.name}")
+            file_size = file_path.stat().st_size
+            if file_size > config.MAX_FILE_SIZE_MB * MB:
+                logging.warning(f"Skipping {source_name}: file size {file_size} bytes exceeds "
+                                f"MAX_FILE_SIZE_MB ({config.MAX_FILE_SIZE_MB}MB)")
                 return
 
-            if text_to_process:
-                documents = self._chunk_and_embed(text_to_process, file_path.name)
-
-            if documents:
-                task = self.index.add_documents(documents, primary_key='id')
-                self.client.wait_for_task(task.task_uid)
-                self._add_to_processed_files(file_path.name)
-                logging.info(f"Successfully processed and indexed {file_path.name}")
+            logging.info(f"Processing file: {source_name}")
+            # JSONのcontentは1つのテキストを切り分けたものなので、区切りを挟まずに結合する
+            separator = "" if file_path.suffix == '.json' else "\n\n"
+            chunks = self._iter_chunks(self._iter_elements(file_path), separator)
+            indexed = self._index_chunks(chunks, source_name)
+            if indexed:
+                self._add_to_processed_files(source_name)
+                logging.info(f"Successfully processed and indexed {source_name} ({indexed} chunks)")
 
         except Exception as e:
-            logging.error(f"Failed to process {file_path.name}: {e}")
+            logging.error(f"Failed to process {source_name}: {e}")
+
+    def _iter_elements(self, file_path):
+        """ファイル形式に応じてテキスト要素を順に返す"""
+        if file_path.suffix == '.json':
+            # json.loadはファイル全体を読み込むため、チャンキングにはCHUNK_BUFFER_SIZEずつ渡す
+            text = self._extract_text_from_json(file_path)
+            for start in range(0, len(text), config.CHUNK_BUFFER_SIZE):
+                yield text[start:start + config.CHUNK_BUFFER_SIZE]
+        elif file_path.suffix == '.pdf':
+            yield from self._extract_elements_from_pdf(file_path)
+        else:
+            yield from self._extract_elements_from_file(file_path)
 
     def _extract_text_from_json(self, file_path):
         """JSONファイルから'content'キーの値をテキストとして抽出する"""
@@ -90,38 +242,167 @@ class IngesterHandler(FileSystemEventHandler):
         logging.warning(f"Could not extract 'content' from JSON file: {file_path.name}")
         return ""
 
-    def _extract_text_from_pdf(self, file_path):
-        elements = partition_pdf(filename=str(file_path), strategy="hi_res")
-        return "\n\n".join([str(el) for el in elements])
+    def _extract_elements_from_pdf(self, file_path):
+        """PDFをPDF_PAGES_PER_PARTITIONページずつ一時ファイルに切り出し、範囲ごとに要素へ分割する"""
+        reader = PdfReader(str(file_path))
+        page_count = len(reader.pages)
+        if page_count <= config.PDF_PAGES_PER_PARTITION:
+            for el in partition_pdf(filename=str(file_path), strategy="hi_res"):
+                yield str(el)
+            return
+
+        for start in range(0, page_count, config.PDF_PAGES_PER_PARTITION):
+            end = min(start + config.PDF_PAGES_PER_PARTITION, page_count)
+            writer = PdfWriter()
+            for page in reader.pages[start:end]:
+                writer.add_page(page)
+            with tempfile.NamedTemporaryFile(dir=config.SPILL_DIR, prefix='ingester-',
+                                             suffix='.pdf', delete=False) as f:
+                writer.write(f)
+                range_path = f.name
+            try:
+                elements = partition_pdf(filename=range_path, strategy="hi_res",
+                                         starting_page_number=start + 1)
+            finally:
+                os.remove(range_path)
+            for el in elements:
+                yield str(el)
+
+    def _extract_elements_from_file(self, file_path):
+        """テキストファイルをブロック単位で読み込み、ブロックごとに要素へ分割する"""
+        for block in self._iter_text_blocks(file_path):
+            for el in partition_text(text=block):
+                yield str(el)
 
-    def _extract_text_from_file(self, file_path):
-        elements = partition_text(filename=str(file_path))
-        return "\n\n".join([str(el) for el in elements])
+    def _iter_text_blocks(self, file_path):
+        """段落の区切り（空行）でTEXT_BLOCK_SIZE程度のブロックに分けて読み込む"""
+        lines = []
+        block_size = 0
+        encoding = self._detect_encoding(file_path)
+        with open(file_path, 'r', encoding=encoding) as f:
+            # 改行のない巨大な行も丸ごと読み込まないよう、1回の読み込みを制限する
+            for line in iter(lambda: f.readline(config.TEXT_BLOCK_SIZE), ''):
+                lines.append(line)
+                block_size += len(line)
+                # 段落の途中で切らないよう、空行に達した時点で区切る。
+                # 空行のないテキストはTEXT_BLOCK_SIZEの2倍に達した時点で行単位で区切る
+                if (block_size >= config.TEXT_BLOCK_SIZE and not line.strip()) \
+                        or block_size >= config.TEXT_BLOCK_SIZE * 2:
+                    yield "".join(lines)
+                    lines = []
+                    block_size = 0
+        if lines:
+            yield "".join(lines)
 
-    def _chunk_and_embed(self, text, source_name):
-        chunks = self.text_splitter.split_text(text)
-        vectors = self.model.encode(chunks).tolist()
+    def _detect_encoding(self, file_path):
+        """TEXT_ENCODINGSの候補から、ファイル全体を読み込まずに復号できる最初のエンコーディングを返す"""
+        for encoding in config.TEXT_ENCODINGS:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            try:
+                with open(file_path, 'rb') as f:
+                    for data in iter(lambda: f.read(MB), b''):
+                        decoder.decode(data)
+                    decoder.decode(b'', final=True)
+                return encoding
+            except UnicodeDecodeError:
+                continue
+        raise ValueError(f"Could not detect encoding of {file_path.name} (tried {', '.join(config.TEXT_ENCODINGS)})")
 
+    def _iter_chunks(self, elements, separator="\n\n"):
+        """要素をCHUNK_BUFFER_SIZE程度まで溜めてから分割し、チャンクを順に返す"""
+        buffer = ""
+        for element in elements:
+            if not element:
+                continue
+            buffer = f"{buffer}{separator}{element}" if buffer else element
+            if len(buffer) < config.CHUNK_BUFFER_SIZE:
+                continue
+            chunks = self.text_splitter.split_text(buffer)
+            buffer = ""
+            if len(chunks) > 1:
+                # 最後のチャンクは後続の要素と結合できるよう持ち越す
+                buffer = chunks.pop()
+            yield from chunks
+        if buffer:
+            yield from self.text_splitter.split_text(buffer)
+
+    def _index_chunks(self, chunks, source_name):
+        """チャンクを上限付きのバッチに分けて埋め込み、Meilisearchに登録する。登録したチャンク数を返す"""
+        batch = []
+        batch_bytes = 0
+        indexed = 0
+        try:
+            for chunk in chunks:
+                batch.append(chunk)
+                batch_bytes += len(chunk.encode('utf-8'))
+                if len(batch) >= config.INGEST_BATCH_SIZE or batch_bytes >= config.INGEST_BATCH_MAX_BYTES:
+                    indexed += self._flush_batch(batch, source_name, indexed)
+                    batch = []
+                    batch_bytes = 0
+            if batch:
+                indexed += self._flush_batch(batch, source_name, indexed)
+        except Exception:
+            # 途中までのバッチが登録済みの場合、部分的なドキュメントが残らないよう取り消す
+            if indexed:
+                logging.error(f"Indexing {source_name} failed after {indexed} chunks were committed; rolling back")
+                self._delete_source(source_name)
+            raise
+        return indexed
+
+    def _flush_batch(self, chunks, source_name, start_id):
+        documents = self._chunk_documents(chunks, self._embed(chunks), source_name, start_id)
+        self._wait_for_task(self.index.add_documents(documents, primary_key='id'))
+        return len(documents)
+
+    def _delete_source(self, source_name):
+        escaped = source_name.replace('\\', '\\\\').replace('"', '\\"')
+        try:
+            self._wait_for_task(self.index.delete_documents(filter=f'source = "{escaped}"'))
+        except Exception as e:
+            logging.error(f"Failed to roll back documents of {source_name}; partial documents remain: {e}")
+
+    def _wait_for_task(self, task_info):
+        task = self.client.wait_for_task(task_info.task_uid)
+        if task.status != 'succeeded':
+            raise RuntimeError(f"Meilisearch task {task_info.task_uid} {task.status}: {task.error}")
+        return task
+
+    def _embed(self, chunks):
+        """チャンクをベクトル化し、float32のNumPy配列として返す"""
+        self.throttle.acquire(len(chunks))
+        return np.asarray(self.model.encode(chunks), dtype=np.float32)
+
+    def _doc_id_prefix(self, source_name):
+        """ドキュメントIDの接頭辞を返す。サブディレクトリのファイルにはパスのハッシュを付けて一意にする"""
+        if '/' not in source_name:
+            return source_name
+        digest = hashlib.sha1(source_name.encode('utf-8')).hexdigest()[:8]
+        return f"{source_name.replace('/', '_')}_{digest}"
+
+    def _chunk_documents(self, chunks, vectors, source_name, start_id=0):
         documents = []
-        for i, (chunk, vector) in enumerate(zip(chunks, vectors)):
-            doc_id = f"{source_name}_chunk_{i:03d}"
+        id_prefix = self._doc_id_prefix(source_name)
+        for i, (chunk, vector) in enumerate(zip(chunks, vectors), start=start_id):
+            doc_id = f"{id_prefix}_chunk_{i:03d}"
             documents.append({
                 "id": doc_id,
                 "content": chunk,
                 "source": source_name,
                 "chunk_id": i,
-                "_vectors": { "default": vector }
+                # シリアライズ直前までfloat32配列のまま保持する
+                "_vectors": { "default": vector.tolist() }
             })
         return documents
 
     def on_created(self, event):
         if not event.is_directory:
-            self.process_file(event.src_path)
+            self.scheduler.submit(event.src_path)
 
     def initial_scan(self):
         logging.info("Starting initial scan of the input directory...")
-        for file_path in self.input_dir.glob('*'):
-            self.process_file(str(file_path))
+        for file_path in self.input_dir.rglob('*'):
+            if file_path.is_file():
+                self.scheduler.submit(str(file_path))
         logging.info("Initial scan finished.")
 
 def main():
@@ -130,16 +411,25 @@ def main():
     index_name = os.getenv("INDEX_NAME", "documents")
     input_dir = os.getenv("INPUT_DIR", "/input/documents")
     log_file_path = os.getenv("LOG_FILE_PATH", "/logs/document-ingester.log")
+    search_metrics_url = os.getenv("SEARCH_METRICS_URL")
 
     setup_logging(log_file_path)
 
     client = meilisearch.Client(meilisearch_url, meilisearch_api_key)
     event_handler = IngesterHandler(client, index_name, input_dir)
 
+    threading.Thread(target=event_handler.scheduler.run, daemon=True).start()
+    if search_metrics_url:
+        threading.Thread(
+            target=poll_search_latency,
+            args=(event_handler.throttle, search_metrics_url, config.METRICS_POLL_INTERVAL_SEC),
+            daemon=True
+        ).start()
+
     event_handler.initial_scan()
 
     observer = Observer()
-    observer.schedule(event_handler, input_dir, recursive=False)
+    observer.schedule(event_handler, input_dir, recursive=True)
     observer.start()
     logging.info(f"Watching for new files in {input_dir}")
 
@@ -148,6 +438,7 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
+        event_handler.scheduler.stop()
     observer.join()
 
 if __name__ == "__main__":
@@ -62,3 +62,26 @@ def test_rag_search_endpoint(client):
             {"content": "chunk2", "source": "doc2.txt", "score": 0.8}
         ]
     }
+
+def test_metrics_endpoint_reports_search_latency(client):
+    """/metricsエンドポイントが検索レイテンシを返すかテスト"""
+    client.post("/rag/search", json={"query": "テストクエリ", "top_k": 2})
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    response_json = response.json()
+    assert response_json["count"] >= 1
+    assert response_json["search_latency_p95_ms"] >= 0.0
+
+def test_metrics_endpoint_drops_stale_samples_after_idle(client, monkeypatch):
+    """検索がない間は古い遅いレイテンシが捨てられ、p95が0に戻るかテスト"""
+    import fastmcp.main as fastmcp_main
+    fastmcp_main.search_latencies_ms.clear()
+    fastmcp_main.search_latencies_ms.append((fastmcp_main.time.monotonic(), 5000.0))
+
+    later = fastmcp_main.time.monotonic() + fastmcp_main.SEARCH_LATENCY_WINDOW_SEC + 1
+    monkeypatch.setattr(fastmcp_main.time, 'monotonic', lambda: later)
+    response = client.get("/metrics")
+
+    assert response.json() == {"search_latency_p95_ms": 0.0, "count": 0}
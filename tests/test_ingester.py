@@ -1,18 +1,29 @@
 import pytest
 import numpy as np
-from unittest.mock import MagicMock, mock_open, patch
+from unittest.mock import MagicMock, patch
 from pathlib import Path
-from ingester import IngesterHandler
+from pypdf import PdfWriter
+from ingester import IngesterHandler, IngestScheduler, EmbeddingThrottle, poll_search_latency
 
 TEST_INDEX_NAME = 'test_documents'
 TEST_INPUT_DIR = '/test/input'
 
+def write_blank_pdf(path, pages=1):
+    """指定ページ数の空白PDFを作成する"""
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=72, height=72)
+    with open(path, 'wb') as f:
+        writer.write(f)
+
 @pytest.fixture
 def mock_meili_client():
     """Meilisearchクライアントのモックを返すフィクスチャ"""
     mock_client = MagicMock()
     mock_index = mock_client.index.return_value
     mock_index.add_documents.return_value = MagicMock(task_uid='123')
+    mock_index.delete_documents.return_value = MagicMock(task_uid='456')
+    mock_client.wait_for_task.return_value = MagicMock(status='succeeded')
     return mock_client
 
 @pytest.fixture
@@ -33,61 +44,249 @@ def handler(mock_meili_client):
             return handler_instance
 
 @patch('ingester.partition_pdf')
-def test_process_pdf_file_calls_chunk_and_embed(mock_partition_pdf, handler):
-    """PDF処理時にチャンキングとベクトル化のメソッドが呼ばれるかテスト"""
+def test_process_pdf_file_indexes_chunks(mock_partition_pdf, handler, tmp_path):
+    """PDF処理時にチャンキング・ベクトル化を経てインデックスに登録されるかテスト"""
     mock_partition_pdf.return_value = ["PDF", "Content"]
-    test_file_path = Path(TEST_INPUT_DIR) / 'document.pdf'
-
-    handler._chunk_and_embed = MagicMock(return_value=[])
+    test_file_path = tmp_path / 'document.pdf'
+    write_blank_pdf(test_file_path)
+    handler.processed_file_path = tmp_path / '.processed'
 
     handler.process_file(str(test_file_path))
 
-    handler._chunk_and_embed.assert_called_once_with("PDF\n\nContent", "document.pdf")
+    handler.text_splitter.split_text.assert_called_once_with("PDF\n\nContent")
+    handler.index.add_documents.assert_called_once()
+    assert 'document.pdf' in handler.processed_files
 
-def test_process_json_file_calls_chunk_and_embed(handler):
-    """JSON処理時にチャンキングとベクトル化のメソッドが呼ばれるかテスト"""
-    test_file_path = Path(TEST_INPUT_DIR) / 'document.json'
+def test_process_json_file_splits_content(handler, tmp_path):
+    """JSON処理時に'content'キーの値がチャンキングされるかテスト"""
+    test_file_path = tmp_path / 'document.json'
     # 単一のJSONオブジェクトを想定
-    json_content = '{"id": "doc1", "content": "This is a JSON content."}'
+    test_file_path.write_text('{"id": "doc1", "content": "This is a JSON content."}', encoding='utf-8')
+    handler.processed_file_path = tmp_path / '.processed'
 
-    handler._chunk_and_embed = MagicMock(return_value=[])
-
-    with patch('builtins.open', mock_open(read_data=json_content)):
-        handler.process_file(str(test_file_path))
+    handler.process_file(str(test_file_path))
 
     # JSONの'content'キーの値が渡されることを期待
-    handler._chunk_and_embed.assert_called_once_with("This is a JSON content.", "document.json")
+    handler.text_splitter.split_text.assert_called_once_with("This is a JSON content.")
+
+def test_process_file_skips_oversized_file(handler, tmp_path, monkeypatch):
+    """MAX_FILE_SIZE_MBを超えるファイルがスキップされるかテスト"""
+    monkeypatch.setattr('config.MAX_FILE_SIZE_MB', 0)
+    test_file_path = tmp_path / 'huge.txt'
+    test_file_path.write_text('too large', encoding='utf-8')
+
+    handler.process_file(str(test_file_path))
+
+    handler.text_splitter.split_text.assert_not_called()
+    handler.index.add_documents.assert_not_called()
+
+@patch('ingester.partition_pdf')
+def test_process_pdf_file_partitions_in_page_ranges(mock_partition_pdf, handler, tmp_path, monkeypatch):
+    """PDFがPDF_PAGES_PER_PARTITIONページずつ一時ファイルに切り出されて解析されるかテスト"""
+    monkeypatch.setattr('config.PDF_PAGES_PER_PARTITION', 2)
+    monkeypatch.setattr('config.SPILL_DIR', str(tmp_path))
+    mock_partition_pdf.return_value = ["Page"]
+    test_file_path = tmp_path / 'large.pdf'
+    write_blank_pdf(test_file_path, pages=5)
+    handler.processed_file_path = tmp_path / '.processed'
+
+    handler.process_file(str(test_file_path))
+
+    assert mock_partition_pdf.call_count == 3
+    assert [c.kwargs['starting_page_number'] for c in mock_partition_pdf.call_args_list] == [1, 3, 5]
+    assert all(c.kwargs['filename'] != str(test_file_path) for c in mock_partition_pdf.call_args_list)
+    # 切り出した一時ファイルは解析後に削除される
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['.processed', 'large.pdf']
+    handler.index.add_documents.assert_called_once()
+
+def test_iter_elements_slices_json_content(handler, tmp_path, monkeypatch):
+    """JSONのcontentがCHUNK_BUFFER_SIZEずつに分けて渡されるかテスト"""
+    monkeypatch.setattr('config.CHUNK_BUFFER_SIZE', 4)
+    test_file_path = tmp_path / 'document.json'
+    test_file_path.write_text('{"content": "abcdefghij"}', encoding='utf-8')
+
+    assert list(handler._iter_elements(test_file_path)) == ["abcd", "efgh", "ij"]
+
+def test_iter_chunks_joins_json_slices_without_separator(handler, monkeypatch):
+    """JSONのスライスのように区切りを指定しない場合、持ち越したチャンクと区切りなしで結合されるかテスト"""
+    monkeypatch.setattr('config.CHUNK_BUFFER_SIZE', 3)
+    handler.text_splitter.split_text.side_effect = lambda text: text.split("|")
+
+    chunks = list(handler._iter_chunks(["a|b", "c"], separator=""))
+
+    assert chunks == ["a", "bc"]
+
+@patch('ingester.partition_text')
+def test_process_text_file_detects_non_utf8_encoding(mock_partition_text, handler, tmp_path):
+    """Shift_JIS（CP932）のテキストファイルも復号してチャンキングされるかテスト"""
+    mock_partition_text.side_effect = lambda text: [text]
+    test_file_path = tmp_path / 'sjis.txt'
+    test_file_path.write_bytes("日本語のテキスト".encode('cp932'))
+    handler.processed_file_path = tmp_path / '.processed'
+
+    handler.process_file(str(test_file_path))
+
+    handler.text_splitter.split_text.assert_called_once_with("日本語のテキスト")
+    assert 'sjis.txt' in handler.processed_files
+
+def test_iter_text_blocks_splits_text_without_blank_lines(handler, tmp_path, monkeypatch):
+    """空行のないテキストもTEXT_BLOCK_SIZEの2倍で行単位に区切られるかテスト"""
+    monkeypatch.setattr('config.TEXT_BLOCK_SIZE', 10)
+    test_file_path = tmp_path / 'log.txt'
+    test_file_path.write_text("line 0001\n" * 6, encoding='utf-8')
+
+    blocks = list(handler._iter_text_blocks(test_file_path))
+
+    assert blocks == ["line 0001\n" * 2] * 3
 
+def test_iter_chunks_carries_last_chunk_over(handler, monkeypatch):
+    """バッファ分割時に最後のチャンクが後続の要素へ持ち越されるかテスト"""
+    monkeypatch.setattr('config.CHUNK_BUFFER_SIZE', 5)
+    handler.text_splitter.split_text.side_effect = lambda text: text.split("|")
 
-def test_chunk_and_embed_creates_correct_documents(handler):
+    chunks = list(handler._iter_chunks(["a|b", "c"]))
+
+    assert chunks == ["a", "b\n\nc"]
+
+def test_index_chunks_creates_correct_documents(handler):
     """チャンキングとベクトル化が正しいドキュメント構造を生成するかテスト"""
-    text = "This is a long text to be chunked."
     source_name = "test.txt"
 
-    documents = handler._chunk_and_embed(text, source_name)
+    indexed = handler._index_chunks(iter(["chunk1", "chunk2"]), source_name)
 
-    handler.text_splitter.split_text.assert_called_once_with(text)
     handler.model.encode.assert_called_once_with(["chunk1", "chunk2"])
 
+    assert indexed == 2
+    documents = handler.index.add_documents.call_args.args[0]
     assert len(documents) == 2
     assert documents[0] == {
         "id": "test.txt_chunk_000",
         "content": "chunk1",
         "source": "test.txt",
         "chunk_id": 0,
-        "_vectors": { "default": [0.1, 0.2, 0.3] }
+        "_vectors": { "default": pytest.approx([0.1, 0.2, 0.3]) }
     }
     assert documents[1] == {
         "id": "test.txt_chunk_001",
         "content": "chunk2",
         "source": "test.txt",
         "chunk_id": 1,
-        "_vectors": { "default": [0.4, 0.5, 0.6] }
+        "_vectors": { "default": pytest.approx([0.4, 0.5, 0.6]) }
     }
 
-def test_on_created_event_calls_process_file(handler):
-    """on_createdイベントがprocess_fileを呼び出すかテスト"""
-    handler.process_file = MagicMock()
+def test_index_chunks_flushes_in_batches(handler, monkeypatch):
+    """INGEST_BATCH_SIZEごとにadd_documentsが呼ばれ、chunk_idが連番になるかテスト"""
+    monkeypatch.setattr('config.INGEST_BATCH_SIZE', 1)
+
+    indexed = handler._index_chunks(iter(["chunk1", "chunk2"]), "test.txt")
+
+    assert indexed == 2
+    assert handler.index.add_documents.call_count == 2
+    ids = [c.args[0][0]["id"] for c in handler.index.add_documents.call_args_list]
+    assert ids == ["test.txt_chunk_000", "test.txt_chunk_001"]
+
+def test_index_chunks_rolls_back_committed_batches_on_failure(handler, monkeypatch):
+    """途中のバッチが失敗した場合、登録済みのバッチが取り消されるかテスト"""
+    monkeypatch.setattr('config.INGEST_BATCH_SIZE', 1)
+    handler.client.wait_for_task.side_effect = [
+        MagicMock(status='succeeded'),
+        MagicMock(status='failed', error={'message': 'boom'}),
+        MagicMock(status='succeeded'),
+    ]
+
+    with pytest.raises(RuntimeError):
+        handler._index_chunks(iter(["chunk1", "chunk2"]), "test.txt")
+
+    handler.index.delete_documents.assert_called_once_with(filter='source = "test.txt"')
+
+def test_on_created_event_submits_to_scheduler(handler):
+    """on_createdイベントがファイルをスケジューラに投入するかテスト"""
+    handler.scheduler = MagicMock()
     mock_event = MagicMock(is_directory=False, src_path=str(Path(TEST_INPUT_DIR) / 'new.txt'))
     handler.on_created(mock_event)
-    handler.process_file.assert_called_once_with(mock_event.src_path)
+    handler.scheduler.submit.assert_called_once_with(mock_event.src_path)
+
+def test_scheduler_orders_by_priority_and_size(tmp_path):
+    """優先度の高いディレクトリ、小さいテキストファイルの順に取り出されるかテスト"""
+    (tmp_path / 'archive').mkdir()
+    (tmp_path / 'urgent').mkdir()
+    files = {
+        'archive': tmp_path / 'archive' / 'old.txt',
+        'pdf': tmp_path / 'report.pdf',
+        'large_text': tmp_path / 'large.txt',
+        'small_text': tmp_path / 'small.txt',
+        'urgent': tmp_path / 'urgent' / 'new.pdf',
+    }
+    files['archive'].write_text('a', encoding='utf-8')
+    files['pdf'].write_bytes(b'%PDF-1.4')
+    files['large_text'].write_text('x' * 100, encoding='utf-8')
+    files['small_text'].write_text('x', encoding='utf-8')
+    files['urgent'].write_bytes(b'%PDF-1.4')
+
+    scheduler = IngestScheduler(MagicMock(), tmp_path)
+    for key in ['archive', 'pdf', 'large_text', 'small_text', 'urgent']:
+        scheduler.submit(str(files[key]))
+
+    order = [scheduler.next(timeout=0) for _ in range(5)]
+
+    assert order == [str(files[key]) for key in ['urgent', 'small_text', 'large_text', 'pdf', 'archive']]
+    assert scheduler.next(timeout=0) is None
+
+def test_scheduler_reclassifies_file_written_after_submit(tmp_path, monkeypatch):
+    """投入後に書き込まれたファイルが、取り出し時のサイズで分類し直されるかテスト"""
+    monkeypatch.setattr('config.SMALL_TEXT_FILE_KB', 0)
+    monkeypatch.setattr('config.LARGE_FILE_MB', 0)
+    huge = tmp_path / 'huge.txt'
+    huge.write_bytes(b'')
+    notes = tmp_path / 'notes.md'
+    notes.write_bytes(b'')
+
+    scheduler = IngestScheduler(MagicMock(), tmp_path)
+    scheduler.submit(str(huge))
+    scheduler.submit(str(notes))
+    huge.write_text('x' * 100, encoding='utf-8')
+
+    assert scheduler.next(timeout=0) == str(notes)
+    assert scheduler.next(timeout=0) == str(huge)
+
+def test_process_file_distinguishes_same_name_in_subdirectories(handler, tmp_path):
+    """サブディレクトリ間で同名のファイルがそれぞれ別のドキュメントとして登録されるかテスト"""
+    handler.input_dir = tmp_path
+    handler.processed_file_path = tmp_path / '.processed'
+    for sub in ['urgent', 'archive']:
+        (tmp_path / sub).mkdir()
+        (tmp_path / sub / 'report.json').write_text('{"content": "text"}', encoding='utf-8')
+
+    handler.process_file(str(tmp_path / 'urgent' / 'report.json'))
+    handler.process_file(str(tmp_path / 'archive' / 'report.json'))
+
+    assert handler.processed_files == {'urgent/report.json', 'archive/report.json'}
+    calls = handler.index.add_documents.call_args_list
+    assert len(calls) == 2
+    assert [c.args[0][0]["source"] for c in calls] == ['urgent/report.json', 'archive/report.json']
+    assert calls[0].args[0][0]["id"] != calls[1].args[0][0]["id"]
+
+def test_throttle_backs_off_when_search_latency_degrades():
+    """検索レイテンシが目標を超えると上限が半減し、回復すると戻るかテスト"""
+    throttle = EmbeddingThrottle(max_rate=10, min_rate=2, latency_target_ms=500)
+
+    throttle.update(800)
+    assert throttle.rate == 5
+    throttle.update(800)
+    throttle.update(800)
+    assert throttle.rate == 2
+
+    throttle.update(100)
+    assert throttle.rate == 3
+
+def test_poll_search_latency_warns_only_once_while_failing(caplog):
+    """メトリクスを取得できない間、警告が最初の1回だけ出力されるかテスト"""
+    throttle = MagicMock()
+    with patch('ingester.urllib.request.urlopen', side_effect=OSError('connection refused')), \
+            patch('ingester.time.sleep', side_effect=[None, None, StopIteration]):
+        with pytest.raises(StopIteration):
+            poll_search_latency(throttle, 'http://fastmcp:8000/metrics', 10)
+
+    warnings = [r for r in caplog.records if r.levelname == 'WARNING']
+    assert len(warnings) == 1
+    throttle.update.assert_not_called()